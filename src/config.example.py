@@ -20,7 +20,8 @@ PRESENCE_LIGHTING_MAPPING = [
         "lights": [{
             "light": "light1_name",  # light name from LIGHTS
             "duration": 45,  # duration in seconds for light to stay on after motion is detected
-            "activeTime": [(0, 800), (1600, 2400)]  # 24-hour format active times
+            # 24-hour format active times, a window ending before it starts wraps past midnight, e.g. (2200, 600)
+            "activeTime": [(0, 800), (1600, 2400)]
         }]
     }
 ]
@@ -13,4 +13,5 @@ pl = utils.PresenceLighting(light_control=lc, light_mapping=config.PRESENCE_LIGH
 event_stream = utils.EventStream(url=getenv("ISAPI_EVENT_URL"),
                                  username=getenv("ISAPI_USERNAME"),
                                  password=getenv("ISAPI_PASSWORD"),
-                                 handle_event=pl.handle_event)
+                                 handle_event=pl.handle_event,
+                                 use_lxml=getenv("ISAPI_USE_LXML", "").lower() in ("1", "true", "yes"))
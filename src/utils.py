@@ -1,10 +1,24 @@
+import random
+import re
 import time
-from threading import Timer
+from collections.abc import Iterable, Iterator
+from heapq import heappop, heappush
+from threading import Condition, Lock, Thread
 
 import requests
 import tinytuya
 from lxml import etree
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
+from urllib3.exceptions import ReadTimeoutError
+
+EVENT_START_TAG = b"<EventNotificationAlert"
+EVENT_END_TAG = b"</EventNotificationAlert>"
+# repeated motion within this many seconds of turning a light on does not resend the command to the device
+REFRESH_COALESCE_SEC = 5
+MINUTES_PER_DAY = 24 * 60
+# the fields handle_event needs, matched in any order since devices differ in element order
+EVENT_FIELDS_RE = re.compile(rb"<(channelID|eventType|dateTime)>([^<]*)</\1>")
 
 
 class EventStream:
@@ -17,7 +31,9 @@ class EventStream:
                  username: str,
                  password: str,
                  handle_event: callable,
-                 max_retries: int = 3):
+                 max_retries: int = 3,
+                 use_lxml: bool = False,
+                 timeout: tuple[float, float] = (5, 60)):
         """
         Initializes the EventStream object to listen to the ISAPI event stream and call the handler function for each event.
         :param url: the URL of the event stream
@@ -25,64 +41,152 @@ class EventStream:
         :param password: the password to use for HTTP Digest Authentication
         :param handle_event: a function to handle each event notification, must accept event data as a parameter
         :param max_retries: the maximum number of times to retry connecting to the event stream
+        :param use_lxml: parse every event with lxml instead of the regex extractor, for nonstandard payloads
+        :param timeout: the (connect, read) timeouts in seconds, a stream silent for longer than the read timeout is
+        reconnected without using up a retry
         """
         self.url = url
         self.username = username
         self.password = password
         self.handle_event = handle_event
         self.max_retries = max_retries
+        self.use_lxml = use_lxml
+        self.timeout = timeout
+        self._connected = False
+        self._delivered = False
+        self._pull = etree.XMLPullParser(events=("end",), recover=True, huge_tree=False)
+
+        # reuse one session across reconnects so the connection and digest auth state are kept
+        self._session = requests.Session()
+        self._session.auth = HTTPDigestAuth(username, password)
+        self._session.headers["Connection"] = "keep-alive"
+        self._session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=0))
 
         self.run()
 
     def run(self):
         """
-        Connects to the event stream and processes each event. Automatically reconnects if the connection is lost, retrying
-        a maximum of max_retries times before giving up.
+        Connects to the event stream and processes each event. Automatically reconnects if the connection is lost,
+        waiting with exponential backoff between attempts and giving up after max_retries consecutive failures. The
+        retry count is only reset once a connection has delivered at least one event. A read timeout on a connected but
+        quiet stream is reconnected after the backoff without using up a retry.
         :return: None
         """
         retries = self.max_retries
         while True:
+            quiet = False
             # noinspection PyBroadException
             try:
                 self.start()
-                retries = self.max_retries
+                print("Event stream closed")
             except Exception as e:
                 print(f"An error occurred: {e}")
+                quiet = self._connected and self._is_read_timeout(e)
+            if self._delivered:
+                retries = self.max_retries
+            elif not quiet:
                 retries -= 1
                 if retries == 0:
                     print("Max retries exceeded, giving up.")
                     break
-                print(f"Retrying in 1 second ({retries} retries left)")
-                time.sleep(1)
+            delay = min(30, 2 ** (self.max_retries - retries)) + random.random() * 0.5
+            print(f"Retrying in {delay:.1f} seconds ({retries} retries left)")
+            time.sleep(delay)
 
     @staticmethod
-    def parse_event(event_xml: str) -> dict:
+    def _is_read_timeout(error: Exception) -> bool:
         """
-        Parses the XML event notification into a dictionary.
-        :param event_xml: the XML event notification
-        :return: a dictionary containing the event data
+        Checks whether the error is a read timeout, raised directly or wrapped while reading the streamed body.
+        :param error: the error raised while connecting to or reading the event stream
+        :return: True if the error is a read timeout, False otherwise
         """
-        root = etree.fromstring(event_xml)
-        event_data = {element.tag.split('}')[1]: element.text for element in root}
+        if isinstance(error, requests.exceptions.ReadTimeout):
+            return True
+        return (isinstance(error, requests.exceptions.ConnectionError) and bool(error.args)
+                and isinstance(error.args[0], ReadTimeoutError))
+
+    def parse_event(self, event_xml: bytes | bytearray) -> dict:
+        """
+        Extracts the channelID, eventType and dateTime fields of the XML event notification into a dictionary. Falls
+        back to parsing the full notification with lxml if use_lxml is set or any of the fields is missing.
+        :param event_xml: the raw bytes of the XML event notification
+        :return: a dictionary mapping the event fields to their text, the same types on both parsing paths
+        """
+        if not self.use_lxml:
+            fields = {}
+            for match in EVENT_FIELDS_RE.finditer(event_xml):
+                fields.setdefault(match.group(1), match.group(2))
+            if len(fields) == 3:
+                return {"channelID": fields[b"channelID"].decode(),
+                        "eventType": fields[b"eventType"].decode(),
+                        "dateTime": fields[b"dateTime"].decode()}
+        return self._parse_event_lxml(event_xml)
+
+    def _parse_event_lxml(self, event_xml: bytes | bytearray) -> dict:
+        """
+        Parses the XML event notification into a dictionary using the reusable pull parser.
+        :param event_xml: the raw bytes of the XML event notification
+        :return: a dictionary containing all the event data
+        """
+        event_data = {}
+        self._pull.feed(bytes(event_xml))
+        for _, element in self._pull.read_events():
+            if element.getparent() is None:
+                event_data = {etree.QName(child).localname: child.text for child in element}
+                element.clear(keep_tail=False)
+        # reset the parser so it accepts the next document
+        self._pull.close()
         return event_data
 
+    @staticmethod
+    def frame_events(chunks: Iterable[bytes]) -> Iterator[bytearray]:
+        """
+        Splits a stream of byte chunks into the individual EventNotificationAlert documents it contains. Every byte is
+        searched for the end tag at most once, apart from an overlap of one end tag length where a tag may straddle two
+        chunks, so framing stays linear in the size of the stream.
+        :param chunks: the raw byte chunks of the event stream
+        :return: an iterator over the undecoded bytes of each event notification
+        """
+        buffer = bytearray()
+        scan = 0
+        for chunk in chunks:
+            buffer.extend(chunk)
+            while True:
+                end = buffer.find(EVENT_END_TAG, scan)
+                if end < 0:
+                    # only the tail of the buffer can hold a partial end tag, so never rescan the rest
+                    scan = max(0, len(buffer) - len(EVENT_END_TAG) + 1)
+                    break
+                end += len(EVENT_END_TAG)
+                begin = max(0, buffer.find(EVENT_START_TAG, 0, end))
+                event = buffer[begin:end]
+                # consumed bytes are dropped, so the buffer always starts after the last complete event
+                del buffer[:end]
+                scan = 0
+                yield event
+
     def start(self):
         """
         Connects to the event stream and processes each event.
         :return: None
         """
-        response = requests.get(self.url, auth=HTTPDigestAuth(self.username, self.password), stream=True)
-        if response.status_code == 200:
-            print("Connected to the event stream")
-            constructed_response = ""
-            for chunk in response.iter_content():
-                constructed_response += chunk.decode("utf-8")
-                if constructed_response.endswith("</EventNotificationAlert>"):
-                    event = constructed_response[constructed_response.find("<EventNotificationAlert"):]
-                    constructed_response = ""
-                    self.handle_event(self.parse_event(event))
-        else:
-            raise Exception(f"Failed to connect to the event stream: {response.status_code}")
+        self._connected = False
+        self._delivered = False
+        # closing the response returns the connection to the session's pool
+        with self._session.get(self.url, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 200:
+                print("Connected to the event stream")
+                self._connected = True
+                for event in self.frame_events(response.iter_content(chunk_size=4096, decode_unicode=False)):
+                    self._delivered = True
+                    # a malformed event should not drop the connection
+                    # noinspection PyBroadException
+                    try:
+                        self.handle_event(self.parse_event(event))
+                    except Exception as e:
+                        print(f"Error handling event: {e}")
+            else:
+                raise Exception(f"Failed to connect to the event stream: {response.status_code}")
 
 
 class LightControl:
@@ -111,32 +215,10 @@ class LightControl:
 
         self.lights = lights
 
-    def _turn_on_switch(self, dev_name: str, switch: int):
-        """
-        Turns on the specified switch of the specified device.
-        :param dev_name: the device ID
-        :param switch: the switch number
-        :return: None
-        """
-        self.device_objects[dev_name].set_status(True, switch=switch, nowait=True)
-
-    def _turn_off_switch(self, dev_name: str, switch: int):
-        """
-        Turns off the specified switch of the specified device.
-        :param dev_name: the device ID
-        :param switch: the switch number
-        :return: None
-        """
-        self.device_objects[dev_name].set_status(False, switch=switch, nowait=True)
-
-    def _get_switch_status(self, dev_name: str, switch: int) -> bool:
-        """
-        Gets the status of the specified switch of the specified device.
-        :param dev_name: the device ID
-        :param switch: the switch number
-        :return: the status of the switch
-        """
-        return self.device_objects[dev_name].status()["dps"][f"{switch}"]
+        # resolve each light to its device object and switch once, so the hot path is a single dict lookup
+        self._bindings: dict[str, tuple[tinytuya.OutletDevice, int]] = {}
+        for name, info in lights.items():
+            self._bindings[name] = (self.device_objects[info["device"]], int(info["switch"]))
 
     def turn_on(self, light_name: str):
         """
@@ -144,7 +226,8 @@ class LightControl:
         :param light_name: the name of the light to turn on
         :return: None
         """
-        self._turn_on_switch(self.lights[light_name]["device"], self.lights[light_name]["switch"])
+        dev, sw = self._bindings[light_name]
+        dev.set_status(True, switch=sw, nowait=True)
 
     def turn_off(self, light_name: str):
         """
@@ -152,7 +235,8 @@ class LightControl:
         :param light_name: the name of the light to turn off
         :return: None
         """
-        self._turn_off_switch(self.lights[light_name]["device"], self.lights[light_name]["switch"])
+        dev, sw = self._bindings[light_name]
+        dev.set_status(False, switch=sw, nowait=True)
 
     def get_status(self, light_name: str) -> bool:
         """
@@ -160,7 +244,110 @@ class LightControl:
         :param light_name: the name of the light
         :return: the status of the light. True if on, False if off.
         """
-        return self._get_switch_status(self.lights[light_name]["device"], self.lights[light_name]["switch"])
+        dev, sw = self._bindings[light_name]
+        return dev.status()["dps"][f"{sw}"]
+
+
+class OffTimerScheduler:
+    """
+    Runs delayed light-off callbacks from a single worker thread instead of one thread per timer.
+    """
+
+    def __init__(self, callback: callable):
+        """
+        Initializes the scheduler and starts its worker thread.
+        :param callback: a function called with the light name and timer epoch when its timer expires, which should
+        confirm the timer with complete() before acting on it
+        """
+        self.callback = callback
+        self._heap: list[tuple[float, str, int]] = []
+        self._epochs: dict[str, int] = {}
+        self._pending: set[str] = set()
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, name="off-timer-scheduler", daemon=True)
+        self._thread.start()
+
+    def schedule(self, light_name: str, duration: float) -> bool:
+        """
+        Schedules the callback for the specified light, replacing any pending timer for it.
+        :param light_name: the name of the light
+        :param duration: the delay in seconds
+        :return: True if a pending timer was replaced, False otherwise
+        """
+        with self._cond:
+            epoch = self._epochs.get(light_name, 0) + 1
+            self._epochs[light_name] = epoch
+            replaced = light_name in self._pending
+            self._pending.add(light_name)
+            heappush(self._heap, (time.monotonic() + duration, light_name, epoch))
+            self._cond.notify()
+        return replaced
+
+    def cancel(self, light_name: str):
+        """
+        Cancels the pending timer for the specified light, if any.
+        :param light_name: the name of the light
+        :return: None
+        """
+        with self._cond:
+            # bumping the epoch makes any queued entry for the light stale
+            self._epochs[light_name] = self._epochs.get(light_name, 0) + 1
+            self._pending.discard(light_name)
+
+    def is_pending(self, light_name: str) -> bool:
+        """
+        Checks whether the specified light has a pending timer.
+        :param light_name: the name of the light
+        :return: True if a timer is pending, False otherwise
+        """
+        with self._cond:
+            return light_name in self._pending
+
+    def complete(self, light_name: str, epoch: int) -> bool:
+        """
+        Marks the expired timer as done if it has not been rescheduled or cancelled since it expired.
+        :param light_name: the name of the light
+        :param epoch: the epoch of the expired timer, as passed to the callback
+        :return: True if the timer is still current and was completed, False if it is stale
+        """
+        with self._cond:
+            if epoch != self._epochs.get(light_name):
+                return False
+            self._pending.discard(light_name)
+            return True
+
+    def _next_expired(self) -> tuple[str, int]:
+        """
+        Blocks until the earliest live timer expires. The light stays pending until the callback completes the timer.
+        :return: the name of the light whose timer expired and the epoch of the timer
+        """
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, light_name, epoch = self._heap[0]
+                if epoch != self._epochs[light_name]:
+                    heappop(self._heap)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    heappop(self._heap)
+                    return light_name, epoch
+                self._cond.wait(timeout=remaining)
+
+    def _run(self):
+        """
+        Worker loop calling the callback for each expired timer.
+        :return: None
+        """
+        while True:
+            light_name, epoch = self._next_expired()
+            # noinspection PyBroadException
+            try:
+                self.callback(light_name, epoch)
+            except Exception as e:
+                print(f"Error running timer for light {light_name}: {e}")
 
 
 class PresenceLighting:
@@ -192,8 +379,21 @@ class PresenceLighting:
                 s.add(light["light"])
 
         print(f"Light mapping: {self.light_mapping}")
-        self.timers: dict[str, Timer | None] = {light["light"]: None for lights in self.light_mapping.values() for light
-                                                in lights}
+
+        # flattened (light, duration, active minute bitmap) tuples per channel, so handle_event does no dict lookups
+        self._plan: dict[int, tuple[tuple[str, int, int | None], ...]] = {}
+        for channel, lights in self.light_mapping.items():
+            entries = []
+            for light in lights:
+                mask = self._active_mask(light["activeTime"]) if light.get("activeTime") else None
+                entries.append((light["light"], light["duration"], mask))
+            self._plan[channel] = tuple(entries)
+        self._scheduler = OffTimerScheduler(callback=self._timer_expired)
+        # serializes turning each light on and off so a motion event cannot interleave with an in-flight off command
+        self._locks: dict[str, Lock] = {light["light"]: Lock() for lights in self.light_mapping.values()
+                                        for light in lights}
+        self._last_on: dict[str, float] = {light["light"]: float("-inf") for lights in self.light_mapping.values()
+                                           for light in lights}
 
     def handle_event(self, event: dict):
         """
@@ -201,27 +401,64 @@ class PresenceLighting:
         :param event: the event data
         :return: None
         """
-        channel_id = int(event["channelID"])
+        # cheapest check first, heartbeats and other non-motion events make up most of the stream
+        if event.get("eventType") != "VMD":
+            return
 
-        if channel_id not in self.light_mapping:
+        channel_id = int(event["channelID"])
+        plan = self._plan.get(channel_id)
+        if plan is None:
             return
 
-        if event["eventType"] == "VMD":
-            motion_military_time = int(event["dateTime"].split("T")[1].replace(":", "")[:4])
-            print(f"Motion detected at channel {channel_id} at {motion_military_time}")
-            for light in self.light_mapping[channel_id]:
-                if light.get("activeTime"):
-                    is_active = False
-                    for period in light["activeTime"]:
-                        start, end = period
-                        if start <= motion_military_time <= end:
-                            is_active = True
-                            self.turn_on(light["light"], light["duration"])
-                            break
-                    if not is_active:
-                        print(f"outside active time for light {light['light']} at channel {channel_id}")
-                else:
-                    self.turn_on(light["light"], light["duration"])
+        motion_military_time = self._hhmm(event["dateTime"])
+        minute = self._hhmm_to_minute(motion_military_time)
+        print(f"Motion detected at channel {channel_id} at {motion_military_time}")
+        for name, duration, mask in plan:
+            if mask is None or (mask >> minute) & 1:
+                self.turn_on(name, duration)
+            else:
+                print(f"outside active time for light {name} at channel {channel_id}")
+
+    @staticmethod
+    def _active_mask(active_time: list) -> int:
+        """
+        Builds a bitmap of the minutes of the day covered by the active time windows.
+        :param active_time: the inclusive (start, end) active time windows in HHMM format, may overlap or touch. A
+        window whose end is before its start wraps past midnight, e.g. (2200, 600).
+        :return: an integer with bit m set if minute m of the day is inside a window
+        """
+        mask = 0
+        for start, end in active_time:
+            first, last = PresenceLighting._hhmm_to_minute(start), PresenceLighting._hhmm_to_minute(end)
+            if last >= first:
+                mask |= ((1 << (last - first + 1)) - 1) << first
+            else:
+                # wraps past midnight: first..end of day, then start of day..last
+                mask |= ((1 << (MINUTES_PER_DAY - first)) - 1) << first
+                mask |= (1 << (last + 1)) - 1
+        return mask
+
+    @staticmethod
+    def _hhmm_to_minute(hhmm: int) -> int:
+        """
+        Converts a military time integer to the minute of the day.
+        :param hhmm: the time in HHMM format, e.g. 1234
+        :return: the minute of the day, e.g. 754
+        """
+        return hhmm // 100 * 60 + hhmm % 100
+
+    @staticmethod
+    def _hhmm(date_time: str) -> int:
+        """
+        Extracts the time of day from an ISO 8601 timestamp as a military time integer.
+        :param date_time: the ISO 8601 timestamp, e.g. 1970-01-01T12:34:56+05:30
+        :return: the time as an integer in HHMM format, e.g. 1234
+        """
+        t = date_time.index("T")
+        if date_time[t + 3] != ":":
+            raise ValueError(f"Invalid event time {date_time}")
+        return ((ord(date_time[t + 1]) - 48) * 1000 + (ord(date_time[t + 2]) - 48) * 100
+                + (ord(date_time[t + 4]) - 48) * 10 + (ord(date_time[t + 5]) - 48))
 
     def turn_on(self, light_name: str, duration: int = 120):
         """
@@ -231,14 +468,18 @@ class PresenceLighting:
         :return: None
         """
         print("attempting to turn on light", light_name)
-        if not self.timers[light_name]:
-            try:
-                self.lc.turn_on(light_name)
-            except Exception as e:
-                print(f"Error turning on light {light_name}: {e}")
-                return
-        if duration:
-            self.set_timer(light_name, duration)
+        with self._locks[light_name]:
+            now = time.monotonic()
+            # a pending off-timer or a recent turn on means the light is already on, so only the timer is extended
+            if not self._scheduler.is_pending(light_name) and now - self._last_on[light_name] > REFRESH_COALESCE_SEC:
+                try:
+                    self.lc.turn_on(light_name)
+                except Exception as e:
+                    print(f"Error turning on light {light_name}: {e}")
+                    return
+                self._last_on[light_name] = now
+            if duration:
+                self.set_timer(light_name, duration)
 
     def set_timer(self, light_name: str, duration: int):
         """
@@ -247,19 +488,38 @@ class PresenceLighting:
         :param duration: the duration in seconds
         :return: None
         """
-        if self.timers[light_name]:
-            self.timers[light_name].cancel()
+        if self._scheduler.schedule(light_name, duration):
             print(f"Cancelled previous timer for light {light_name}")
-        self.timers[light_name] = Timer(duration, lambda l=light_name: self.turn_off(l))
-        self.timers[light_name].start()
         print(f"Set timer for light {light_name} for {duration} seconds")
 
     def turn_off(self, light_name: str):
         """
-        Turns off the specified light.
+        Turns off the specified light and cancels its pending timer.
+        :param light_name: the name of the light
+        :return: None
+        """
+        with self._locks[light_name]:
+            self._scheduler.cancel(light_name)
+            self._send_off(light_name)
+
+    def _timer_expired(self, light_name: str, epoch: int):
+        """
+        Turns off the specified light when its timer expires, unless motion rescheduled the timer in the meantime.
+        :param light_name: the name of the light
+        :param epoch: the epoch of the expired timer
+        :return: None
+        """
+        with self._locks[light_name]:
+            if self._scheduler.complete(light_name, epoch):
+                self._send_off(light_name)
+
+    def _send_off(self, light_name: str):
+        """
+        Sends the turn off command for the specified light, must be called with the light's lock held.
         :param light_name: the name of the light
         :return: None
         """
         print("Turning off light", light_name)
         self.lc.turn_off(light_name)
-        self.timers[light_name] = None
+        # only reopen the coalescing window once the off command has been sent
+        self._last_on[light_name] = float("-inf")